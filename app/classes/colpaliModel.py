@@ -1,35 +1,127 @@
 import logging
+from typing import List, Literal, Optional, Tuple
 from PIL.Image import Image
 from colpali_engine.models import ColPali
 import torch
-from transformers import AutoProcessor
+from transformers import AutoProcessor, BatchFeature
+from transformers.utils import is_flash_attn_2_available
+
+from app.config import Config
 
 class ColPaliModel:
-    def __init__(self, model_name: str = "vidore/colpali-v1.3"):
+    def __init__(self, model_name: str = "vidore/colpali-v1.3",
+                 quantization: Optional[Literal["bf16", "fp8", "int8"]] = None):
         self.model_name = model_name
         self.device = self._get_optimal_device() # Determina el dispositivo óptimo para procesamiento (GPU si está disponible, de lo contrario CPU)
         self.model = ColPali.from_pretrained(
             self.model_name,
             dtype=torch.bfloat16 if self.device == "cuda" else torch.float32,
-            device_map=self.device) # Cargamos el modelo una sola vez en el dispositivo óptimo
+            device_map=self.device,
+            attn_implementation=self._get_attn_implementation()).eval() # Cargamos el modelo una sola vez en el dispositivo óptimo
+        self.quantization = self._quantize(quantization or Config.COLPALI_QUANTIZATION) # Cuantización de pesos efectivamente aplicada
         self.processor = AutoProcessor.from_pretrained(self.model_name) # Cargamos el procesador una sola vez
+        self.batch_size = self._get_batch_size() # Número de páginas que se procesan en cada forward
+        self.image_size = self._get_image_size() # (alto, ancho) de entrada del modelo, p. ej. (448, 448)
+        if self.device == "cuda":
+            self._enable_cuda_optimizations()
+        self._page_model = self._compile_page_model() # Modelo usado para las páginas (compilado si COLPALI_COMPILE)
 
     # --- Metodos privados ---
     def _get_optimal_device(self):
-        if torch.cuda.is_available():
-            return "cuda"
-        
+        # Si el driver de la GPU falla, from_pretrained(device_map="cuda") lo reportará con un error claro
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    def _get_attn_implementation(self) -> Optional[str]:
+        # FlashAttention 2 (atención fusionada, sin materializar la matriz tokens x tokens) si el
+        # paquete flash-attn está instalado y hay GPU; si no, la implementación por defecto (SDPA/eager)
+        if self.device == "cuda" and is_flash_attn_2_available():
+            return "flash_attention_2"
+        return None
+
+    def _enable_cuda_optimizations(self):
+        """
+        Ajustes de rendimiento para inferencia en GPU:
+        - cudnn.benchmark: elige el algoritmo de convolución más rápido para las formas fijas de entrada.
+        - matmul en precisión "high": permite TF32 en las operaciones que queden en fp32.
+        - channels_last en las convoluciones (patch embedding de la torre de visión), que en
+          bf16/fp16 usan kernels de tensor cores más rápidos con este formato de memoria.
+        """
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+        for module in self.model.modules():
+            if isinstance(module, torch.nn.Conv2d):
+                module.to(memory_format=torch.channels_last)
+
+    def _compile_page_model(self):
+        """
+        Compila el modelo con torch.compile(mode="reduce-overhead") para capturar CUDA Graphs
+        en el forward de páginas. El procesador redimensiona todas las páginas al mismo tamaño,
+        así que la única forma variable es el tamaño de lote. Con la caché de embeddings por página
+        un lote puede llevar cualquier número de páginas entre 1 y batch_size, y cada tamaño nuevo
+        supondría otra recompilación y otra captura (hasta agotar el límite de recompilaciones de
+        dynamo y volver a eager sin avisar). Por eso embed_inputs rellena siempre los lotes hasta
+        batch_size cuando el modelo está compilado: se compila una sola forma.
+        Las consultas de texto, de longitud variable, siguen usando el modelo sin compilar.
+        """
+        if not Config.COLPALI_COMPILE or self.device != "cuda":
+            return self.model
+        return torch.compile(self.model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+
+    def _quantize(self, quantization: str) -> str:
+        """
+        Aplica cuantización weight-only (torchao) a las capas lineales del modelo.
+        Las activaciones y el embedding de salida se mantienen en bf16/fp32, por lo que
+        los vectores que se envían a Qdrant no cambian de formato.
+        - "fp8": requiere GPU con compute capability >= 8.9 (Ada/Hopper).
+        - "int8": válido en GPU y CPU.
+        Si la cuantización no es aplicable se continúa sin ella y se devuelve "bf16".
+        """
+        if quantization == "bf16":
+            return "bf16"
+        if quantization not in ("fp8", "int8"):
+            logging.warning(f"Cuantización '{quantization}' no soportada. Se usará bf16.")
+            return "bf16"
+        if quantization == "fp8" and (self.device != "cuda" or torch.cuda.get_device_capability() < (8, 9)):
+            logging.warning("FP8 requiere una GPU con compute capability >= 8.9. Se usará bf16.")
+            return "bf16"
+
         try:
-            # Intentamos una operación minúscula en GPU para validar el driver
-            torch.cuda.current_device()
-            torch.tensor([0.0]).cuda() 
-            return "cuda"
-        except Exception as e:
-            logging.warning(f"GPU detectada pero no funcional (posible error de driver): {e}")
-            return "cpu"
+            from torchao.quantization import quantize_, Float8WeightOnlyConfig, Int8WeightOnlyConfig
+        except ImportError:
+            logging.warning("torchao no está instalado (pip install rag-mariadb-qdrant[quant]). Se usará bf16.")
+            return "bf16"
+
+        config = Float8WeightOnlyConfig() if quantization == "fp8" else Int8WeightOnlyConfig()
+        quantize_(self.model, config)
+        return quantization
+
+    def _get_batch_size(self) -> int:
+        """
+        Devuelve el tamaño de lote para el procesado de páginas.
+        Si COLPALI_BATCH_SIZE no está definido (0), se estima a partir de la VRAM libre:
+        aproximadamente 1 página por cada 2 GB libres, con un máximo de 16.
+        """
+        if Config.COLPALI_BATCH_SIZE > 0:
+            return Config.COLPALI_BATCH_SIZE
+        if self.device != "cuda":
+            return 4
+        free_bytes, _total = torch.cuda.mem_get_info()
+        return max(1, min(16, int(free_bytes // (2 * 1024**3))))
+
+    def _get_image_size(self) -> Optional[Tuple[int, int]]:
+        """
+        Devuelve el tamaño (alto, ancho) al que el procesador redimensiona las páginas,
+        o None si el procesador no lo expone.
+        """
+        size = getattr(getattr(self.processor, "image_processor", None), "size", None) or {}
+        if "height" in size and "width" in size:
+            return int(size["height"]), int(size["width"])
+        return None
 
     # --- Metodos publicos ---   
     def close(self):
+        # Sin compilar, _page_model es el propio modelo: hay que soltar las dos referencias
+        del self._page_model
         if self.model:
             del self.model
         if self.processor:
@@ -39,18 +131,89 @@ class ColPaliModel:
     
     def process_page(self, image: Image) -> torch.Tensor:
         """
-        Procesa una página combinando su imagen y texto para generar un embedding multi-vectorial.
-        Utiliza el modelo ColPali para extraer características visuales y textuales, y las combina
-        en un solo vector de alta dimensión que representa la información completa de la página.
+        Procesa una única página. Atajo sobre process_pages para un lote de tamaño 1.
         Args:
             image (PIL.Image): La imagen renderizada de la página PDF.
         Returns:
-            torch.Tensor: Un tensor que representa el embedding multi-vectorial de la página.
+            torch.Tensor: Un tensor [1, tokens, dim] con el embedding multi-vectorial de la página.
         """
-        inputs = self.processor(images=image, return_tensors="pt", padding=True, truncation=True).to(self.model.device)
-        with torch.no_grad():
-            embeddings = self.model(**inputs)
-        return embeddings.cpu() # Devuelve el embedding en CPU para su posterior uso
+        return self.process_pages([image])
+
+    def process_pages(self, images: List[Image]) -> torch.Tensor:
+        """
+        Procesa un lote de páginas en un único forward del modelo ColPali.
+        Agrupar las páginas reduce las llamadas al procesador y los lanzamientos de kernels
+        respecto a procesar cada página por separado.
+        Args:
+            images (List[PIL.Image]): Las imágenes renderizadas de las páginas PDF.
+        Returns:
+            torch.Tensor: Un tensor [B, tokens, dim] en el dispositivo del modelo.
+        """
+        return self.embed_inputs(self.prepare_pages(images))
+
+    def prepare_pages(self, images: List[Image]) -> BatchFeature:
+        """
+        Ejecuta solo el procesador (CPU) sobre un lote de imágenes.
+        En GPU, los tensores se dejan en memoria fijada (pinned) para que la copia al
+        dispositivo en embed_inputs sea asíncrona. Puede llamarse desde un hilo productor
+        mientras la GPU procesa el lote anterior.
+        Args:
+            images (List[PIL.Image]): Las imágenes renderizadas de las páginas PDF.
+        Returns:
+            BatchFeature: Entradas del modelo en CPU.
+        """
+        inputs = self.processor(images=images, return_tensors="pt", padding=True)
+        if self.device == "cuda":
+            for key, value in inputs.items():
+                if isinstance(value, torch.Tensor):
+                    inputs[key] = value.pin_memory()
+        return inputs
+
+    def embed_inputs(self, inputs: BatchFeature) -> torch.Tensor:
+        """
+        Ejecuta el forward de ColPali sobre entradas ya preparadas con prepare_pages.
+        Args:
+            inputs (BatchFeature): Entradas del modelo en CPU.
+        Returns:
+            torch.Tensor: Un tensor [B, tokens, dim] en el dispositivo del modelo.
+        """
+        inputs = inputs.to(self.model.device, non_blocking=True)
+        compiled = self._page_model is not self.model
+        n_pages = inputs["pixel_values"].shape[0] if "pixel_values" in inputs else None
+        if compiled and n_pages is not None and n_pages < self.batch_size:
+            # Forma fija para el modelo compilado: se repite la última página hasta batch_size
+            # (en el dispositivo, tras la copia) y luego se descartan esas filas de la salida
+            pad = self.batch_size - n_pages
+            for key, value in inputs.items():
+                if isinstance(value, torch.Tensor) and value.shape[0] == n_pages:
+                    inputs[key] = torch.cat([value, value[-1:].expand(pad, *value.shape[1:])])
+        if self.device == "cuda" and "pixel_values" in inputs:
+            inputs["pixel_values"] = inputs["pixel_values"].contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            embeddings = self._page_model(**inputs)
+        if compiled:
+            # La salida de un CUDA Graph se reutiliza en la siguiente ejecución: la copiamos
+            embeddings = embeddings[:n_pages].clone()
+        return embeddings # Se mantiene en el dispositivo; el consumidor decide cuándo copiar a CPU
+
+    def copy_to_host(self, embeddings: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """
+        Inicia la copia de los embeddings a CPU en fp16 (formato de almacenamiento en Qdrant).
+        En GPU la copia es asíncrona sobre memoria fijada y se devuelve un evento CUDA: hay que
+        llamar a event.synchronize() antes de leer el tensor. En CPU no hay copia ni evento.
+        Args:
+            embeddings (torch.Tensor): Embeddings [B, tokens, dim] en el dispositivo del modelo.
+        Returns:
+            Tuple[torch.Tensor, Optional[torch.cuda.Event]]: Tensor en CPU y evento de fin de copia.
+        """
+        embeddings = embeddings.half()
+        if self.device != "cuda":
+            return embeddings, None
+        host = torch.empty(embeddings.shape, dtype=embeddings.dtype, pin_memory=True)
+        host.copy_(embeddings, non_blocking=True)
+        ready = torch.cuda.Event()
+        ready.record()
+        return host, ready
 
     def process_text(self, text: str) -> torch.Tensor:
         """
@@ -61,10 +224,25 @@ class ColPaliModel:
         Returns:
             torch.Tensor: Un tensor que representa el embedding multi-vectorial del texto.
         """
-        inputs = self.processor(text=[text], return_tensors="pt", padding=True, truncation=True).to(self.model.device)
-        with torch.no_grad():
+        inputs = self.processor(text=[text], return_tensors="pt", padding=True, truncation=True).to(self.model.device, non_blocking=True)
+        with torch.inference_mode():
             embeddings = self.model(**inputs)
         return embeddings.cpu()  # Devuelve el embedding en CPU para su posterior uso
+
+    def process_text_batch(self, texts: List[str]) -> List[torch.Tensor]:
+        """
+        Genera los embeddings de varias preguntas con una sola pasada por el modelo.
+        Args:
+            texts (List[str]): Textos de entrada (preguntas del usuario).
+        Returns:
+            List[torch.Tensor]: Un tensor [tokens, dim] en CPU por texto, sin los tokens de padding
+                (si no, el relleno de las preguntas cortas contaría en el MAX_SIM).
+        """
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(self.model.device, non_blocking=True)
+        with torch.inference_mode():
+            embeddings = self.model(**inputs).cpu()
+        mask = inputs["attention_mask"].bool().cpu()
+        return [embedding[row_mask] for embedding, row_mask in zip(embeddings, mask)]
     
     # --- Metodos de contexto ---
     def __enter__(self):
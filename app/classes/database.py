@@ -1,18 +1,35 @@
-from typing import Union, Tuple, Any
+from typing import Dict, Iterable, List, Optional, Union, Tuple, Any
 from dataclasses import dataclass
-import os
+from collections import OrderedDict
+import threading
 import pymysql
+from dbutils.pooled_db import PooledDB
 import logging
 import torch
 import json
 from app.config import Config
 from app.classes.document import Document
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, MultiVectorComparator, MultiVectorConfig, QueryResponse
+from qdrant_client.models import (
+    Distance, VectorParams, MultiVectorComparator, MultiVectorConfig, QueryResponse, PointStruct,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, HnswConfigDiff, Datatype,
+    SearchParams, QuantizationSearchParams, PayloadSchemaType, Filter, FieldCondition, MatchValue,
+    QueryRequest, PayloadSelectorInclude
+)
 # Importamos con alias para que VS Code esté feliz y el código sea legible
 from qdrant_client.http.models.models import QueryResponse as QResponse
 
-@dataclass
+# Columnas en el orden que espera DocumentRecord.from_row (sin el JSON de metadatos)
+_DOCUMENT_COLUMNS = "id, doc_hash, filename, upload_path, total_pages, indexed_in_qdrant, created_at"
+
+# Campos del payload que usa /search; el resto (y los vectores) no se piden a Qdrant
+_SEARCH_PAYLOAD_FIELDS = ["document_hash", "page_number", "text", "figure_captions"]
+
+# Máximo de registros de documentos que se guardan en memoria (caché LRU por hash)
+_DOCUMENT_CACHE_SIZE = 4096
+
+
+@dataclass(frozen=True)
 class DocumentRecord:
     """
         Data class representing a document record in the dataMariaDbbase.
@@ -48,8 +65,7 @@ class Database:
     Database management class for RAG (Retrieval-Augmented Generation) system.
     
     Attributes:
-        mariadb_connection: PyMySQL connection object for MariaDB
-        mariadb_cursor: Cursor object for executing MariaDB queries
+        mariadb_pool: Pool of PyMySQL connections (DBUtils PooledDB); each method borrows one
         qdrant_client: QdrantClient instance for vector database operations
     
     Methods:
@@ -57,7 +73,7 @@ class Database:
         _init_mariadb(): Initialize MariaDB connection and create tables
         _create_tables(): Create documents and pages tables in MariaDB
         _init_qdrant(): Initialize Qdrant client and create collection
-        get_mariadb_connection(): Return the MariaDB connection object
+        get_mariadb_connection(): Borrow a MariaDB connection from the pool
         get_qdrant_client(): Return the Qdrant client instance
     
     Tables:
@@ -69,14 +85,33 @@ class Database:
             - total_pages: INT DEFAULT 0
             - indexed_in_qdrant: BOOLEAN DEFAULT FALSE
             - created_at: TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        pages: Stores the extracted text of each page
+            - id: INT AUTO_INCREMENT PRIMARY KEY
+            - document_id: INT NOT NULL (FK documents.id)
+            - page_number: INT NOT NULL
+            - content: MEDIUMTEXT
+            - metadata: JSON (blocks, tables_text, device_used)
+            - UNIQUE KEY unique_page (document_id, page_number)
+        page_embedding_cache: Maps the hash of a rendered page to the Qdrant point holding its embedding
+            - page_hash: VARCHAR(160) PRIMARY KEY (model name + SHA-256 of the page pixels)
+            - point_id: CHAR(36) NOT NULL
+            - created_at: TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         
     Qdrant Collection:
         rag_collection: Vector collection configured with ColBERT embeddings
             - Vector size: 768 dimensions
             - Distance metric: COSINE
+            - Datatype: FLOAT16
             - Multi-vector comparator: MAX_SIM
+            - Scalar quantization: INT8 (always in RAM)
+            - HNSW: m=16, ef_construct=128
     """
     def __init__(self):
+        # Caché LRU doc_hash -> DocumentRecord; los métodos que modifican un documento lo invalidan
+        self._document_cache: "OrderedDict[str, DocumentRecord]" = OrderedDict()
+        self._document_cache_lock = threading.Lock()
+        # Se incrementa en cada invalidación: una lectura que empezó antes no puede rellenar la caché
+        self._document_cache_generation = 0
         self._init_mariadb()
         self._init_qdrant()
     
@@ -84,85 +119,230 @@ class Database:
     
     def _init_mariadb(self):
         # Código para inicializar la conexión a MariaDB
+        # Pool de conexiones: peticiones concurrentes no comparten (ni serializan) una única conexión
         try:
-            self.mariadb_connection = pymysql.connect(
+            self.mariadb_pool = PooledDB(
+                creator=pymysql,
+                mincached=Config.MARIADB_POOL_MIN, # Conexiones abiertas al arrancar
+                maxconnections=Config.MARIADB_POOL_MAX,
+                blocking=True, # Con el pool agotado se espera a que se libere una conexión en lugar de fallar
                 host=Config.MARIADB_HOST,
                 user=Config.MARIADB_USER,
                 password=Config.MARIADB_PASSWORD,
                 port=Config.MARIADB_PORT,
-                database=Config.MARIADB_DATABASE 
+                database=Config.MARIADB_DATABASE,
+                autocommit=False, # Las escrituras se confirman explícitamente, una vez por transacción
+                local_infile=False # No se usa LOAD DATA LOCAL; las cargas masivas van por executemany
             )
-            self.mariadb_cursor = self.mariadb_connection.cursor()
             self._create_tables()
         except pymysql.MySQLError as e:
             print(f"Error al conectar a MariaDB: {e}")
 
     def _create_tables(self):
-        # Crear la tabla de documentos si no existe
-        self.mariadb_cursor.execute("""
-            CREATE TABLE IF NOT EXISTS documents (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                doc_hash VARCHAR(64) UNIQUE NOT NULL,
-                filename VARCHAR(255) NOT NULL,
-                upload_path VARCHAR(512) NOT NULL,
-                total_pages INT DEFAULT 0,
-                indexed_in_qdrant BOOLEAN DEFAULT FALSE,
-                metadata JSON, -- Campo para metadatos extra (autor, fechas, etiquetas, etc.)
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            ) ENGINE=InnoDB
-        """)
-
-        self.mariadb_connection.commit()
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            # Crear la tabla de documentos si no existe
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    doc_hash VARCHAR(64) UNIQUE NOT NULL, -- UNIQUE crea el índice que usan las búsquedas por hash
+                    filename VARCHAR(255) NOT NULL,
+                    upload_path VARCHAR(512) NOT NULL,
+                    total_pages INT DEFAULT 0,
+                    indexed_in_qdrant BOOLEAN DEFAULT FALSE,
+                    metadata JSON, -- Campo para metadatos extra (autor, fechas, etiquetas, etc.)
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB
+            """)
+
+            # Crear la tabla de páginas si no existe
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    document_id INT NOT NULL,
+                    page_number INT NOT NULL,
+                    content MEDIUMTEXT,
+                    metadata JSON, -- Datos voluminosos de la página (bloques con bbox, tablas) que no van al payload de Qdrant
+                    -- Las lecturas por (documento, página) resuelven por este índice; no se añade un índice
+                    -- con prefijo de content: InnoDB nunca usa un índice de prefijo como índice cubriente
+                    UNIQUE KEY unique_page (document_id, page_number),
+                    FOREIGN KEY (document_id) REFERENCES documents(id) ON DELETE CASCADE
+                ) ENGINE=InnoDB ROW_FORMAT=DYNAMIC -- content y metadata largos se guardan fuera de la fila del índice clúster
+            """)
+
+            # Caché de embeddings por página: páginas idénticas (portadas, plantillas) no se vuelven a pasar por ColPali
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS page_embedding_cache (
+                    page_hash VARCHAR(160) PRIMARY KEY, -- "{modelo}:{sha256 de los píxeles renderizados}"
+                    point_id CHAR(36) NOT NULL, -- Punto de Qdrant que ya tiene el multivector de esa página
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB
+            """)
+
+            conn.commit()
 
     def _init_qdrant(self):
         # Código para inicializar la conexión a Qdrant
         try:
+            # gRPC: los vectores viajan como Protobuf binario en lugar de JSON
             self.qdrant_client = QdrantClient(
             host=Config.QDRANT_HOST,
-            port=Config.QDRANT_PORT)
+            port=Config.QDRANT_PORT,
+            grpc_port=Config.QDRANT_GRPC_PORT,
+            prefer_grpc=True,
+            timeout=Config.QDRANT_TIMEOUT) # Un Qdrant colgado no bloquea el arranque indefinidamente
         except Exception as e:
             print(f"Error al conectar a Qdrant: {e}")
         # Crear la colección si no existe
         collection_name = Config.QDRANT_COLLECTION
-        try:
-            self.qdrant_client.get_collection(collection_name)
-        except:
+        if not self.qdrant_client.collection_exists(collection_name):
             self.qdrant_client.create_collection(
                 collection_name=collection_name,
                 vectors_config={
                     "colbert" : VectorParams(
                         size=128, # El tamaño de los embeddings de ColPali es 128 dimensiones
                         distance=Distance.COSINE,
+                        datatype=Datatype.FLOAT16, # Almacena los vectores originales en fp16 (mitad de disco/RAM que fp32)
                         multivector_config=MultiVectorConfig(
                             comparator=MultiVectorComparator.MAX_SIM
                         )
                     )
-                }
+                },
+                # Cuantización escalar INT8: ~4x menos memoria y MAX_SIM más rápido sobre int8
+                quantization_config=ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True)
+                ),
+                hnsw_config=HnswConfigDiff(m=16, ef_construct=128, on_disk=False)
             )
+        # Índices de payload para poder pre-filtrar por documento/página en las búsquedas.
+        # Fuera del if: crearlos es idempotente y así también los reciben las colecciones ya existentes
+        self.qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name="document_hash",
+            field_schema=PayloadSchemaType.KEYWORD
+        )
+        self.qdrant_client.create_payload_index(
+            collection_name=collection_name,
+            field_name="page_number",
+            field_schema=PayloadSchemaType.INTEGER
+        )
     
+    def _cache_get(self, doc_hash: str) -> Optional[DocumentRecord]:
+        with self._document_cache_lock:
+            record = self._document_cache.get(doc_hash)
+            if record is not None:
+                self._document_cache.move_to_end(doc_hash)
+            return record
+
+    def _cache_generation(self) -> int:
+        with self._document_cache_lock:
+            return self._document_cache_generation
+
+    def _cache_put(self, record: DocumentRecord, generation: int) -> None:
+        with self._document_cache_lock:
+            # Si hubo una invalidación desde que empezó el SELECT, el registro puede estar obsoleto
+            if generation != self._document_cache_generation:
+                return
+            self._document_cache[record.doc_hash] = record
+            self._document_cache.move_to_end(record.doc_hash)
+            if len(self._document_cache) > _DOCUMENT_CACHE_SIZE:
+                self._document_cache.popitem(last=False)
+
+    @staticmethod
+    def _document_filter(doc_hash: Optional[str]) -> Optional[Filter]:
+        # Pre-filtrado por documento mediante el índice de payload `document_hash`
+        if not doc_hash:
+            return None
+        return Filter(must=[FieldCondition(key="document_hash", match=MatchValue(value=doc_hash))])
+
+    @staticmethod
+    def _search_params() -> SearchParams:
+        # Busca sobre los vectores int8 y reordena los candidatos con los originales
+        return SearchParams(
+            quantization=QuantizationSearchParams(rescore=True, oversampling=2.0),
+            hnsw_ef=128
+        )
+
     # --- Metodos publicos ---
                                                                                                                                                                                   
     def get_mariadb_connection(self):
-        return self.mariadb_connection
+        # Conexión prestada del pool: usar con `with` (o cerrarla) para devolverla
+        return self.mariadb_pool.connection()
     
     def get_qdrant_client(self):
         return self.qdrant_client
 
-    def get_document_by_hash(self, doc_hash: str) -> Union[DocumentRecord, None]:
+    def invalidate_document(self, doc_hash: str) -> None:
+        """
+        Descarta de la caché el registro de un documento para que la siguiente lectura vaya a MariaDB.
+
+        Args:
+            doc_hash (str): The hash of the document to invalidate.
+        """
+        with self._document_cache_lock:
+            self._document_cache.pop(doc_hash, None)
+            self._document_cache_generation += 1
+
+    def get_document_by_hash(self, doc_hash: str, use_cache: bool = True) -> Union[DocumentRecord, None]:
         """
         Check if a document with the given hash exists in the documents table.
+        Found records are served from an in-process LRU cache on later calls.
 
         Args:
             doc_hash (str): The SHA-256 hash of the document to check.
+            use_cache (bool): If False, always read from MariaDB (and do not fill the cache).
+                Use it for checks that decide whether to write, e.g. before ingesting.
 
         Returns:
             DocumentRecord: The document record if it exists, False otherwise.
         """
-        query = "SELECT * FROM documents WHERE doc_hash = %s"
-        self.mariadb_cursor.execute(query, (doc_hash,))
-        result = self.mariadb_cursor.fetchone()
+        if use_cache:
+            cached = self._cache_get(doc_hash)
+            if cached is not None:
+                return cached
+        generation = self._cache_generation()
+        query = f"SELECT {_DOCUMENT_COLUMNS} FROM documents WHERE doc_hash = %s"
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (doc_hash,))
+            result = cursor.fetchone()
         doc_record = DocumentRecord.from_row(result) if result else None
+        # Solo se cachean los aciertos: un documento ausente puede insertarlo otro proceso
+        if doc_record and use_cache:
+            self._cache_put(doc_record, generation)
         return doc_record if doc_record else None
+
+    def get_documents_by_hashes(self, doc_hashes: Iterable[str]) -> Dict[str, DocumentRecord]:
+        """
+        Retrieve several documents by hash with a single IN query.
+        Hashes already in the LRU cache are not queried again.
+
+        Args:
+            doc_hashes (Iterable[str]): The hashes to look up (duplicates are ignored).
+
+        Returns:
+            Dict[str, DocumentRecord]: Records keyed by doc_hash. Unknown hashes are absent.
+        """
+        found: Dict[str, DocumentRecord] = {}
+        missing = []
+        for doc_hash in set(doc_hashes):
+            cached = self._cache_get(doc_hash)
+            if cached is not None:
+                found[doc_hash] = cached
+            else:
+                missing.append(doc_hash)
+        if not missing:
+            return found
+        generation = self._cache_generation()
+        # PyMySQL expande la tupla a ('h1', 'h2', ...)
+        query = f"SELECT {_DOCUMENT_COLUMNS} FROM documents WHERE doc_hash IN %s"
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (tuple(missing),))
+            rows = cursor.fetchall()
+        for row in rows:
+            record = DocumentRecord.from_row(row)
+            if record:
+                self._cache_put(record, generation)
+                found[record.doc_hash] = record
+        return found
         
     
     def update_document_path(self, doc_hash: str, new_path: str) -> None:
@@ -174,8 +354,10 @@ class Database:
             new_path (str): The new upload path to set.
         """
         query = "UPDATE documents SET upload_path = %s WHERE doc_hash = %s"
-        self.mariadb_cursor.execute(query, (new_path, doc_hash))
-        self.mariadb_connection.commit()
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (new_path, doc_hash))
+            conn.commit()
+        self.invalidate_document(doc_hash)
 
     def mark_document_indexed(self, doc_hash: str) -> None:
         """
@@ -185,15 +367,18 @@ class Database:
             doc_hash (str): The SHA-256 hash of the document to update.
         """
         query = "UPDATE documents SET indexed_in_qdrant = TRUE WHERE doc_hash = %s"
-        self.mariadb_cursor.execute(query, (doc_hash,))
-        self.mariadb_connection.commit()
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (doc_hash,))
+            conn.commit()
+        self.invalidate_document(doc_hash)
         
     def insert_document(self, document: Document) -> dict:
         """
-        Inserts a new document and its pages into the database.
-        This method adds a new record to the `documents` table using the provided `Document` object,
-        then inserts each page of the document into the `pages` table. If a page already exists for the
-        given document and page number, its content is updated.
+        Inserts a document into the `documents` table, or updates its upload_path if a row with the
+        same doc_hash already exists, in a single statement (INSERT ... ON DUPLICATE KEY UPDATE).
+        In both cases `document_id` is the id of the row (LAST_INSERT_ID(id) trick), so callers do not
+        need a previous existence check and two concurrent uploads of the same file cannot double-insert.
+        Pages are written separately with `bulk_insert_pages`.
         Args:
             document (Document): The Document object to insert, containing metadata and page content.
         Returns:
@@ -202,44 +387,200 @@ class Database:
             Exception: If any error occurs during the insertion, the transaction is rolled back and the exception is raised.
         """
 
-        try:
-            with self.mariadb_connection.cursor() as cursor:
-                doc_hash = document.hash
-                upload_path = document.upload_path
-                filename = os.path.basename(upload_path)
-                total_pages = document.total_pages
-                metadata_json = json.dumps(document.metadata) if document.metadata else None
-
-                # Insertar el documento en la tabla documents
-                query = """
-                    INSERT INTO documents (doc_hash, filename, upload_path, total_pages, metadata)
-                    VALUES (%s, %s, %s, %s, %s)
-                """
-                cursor.execute(query, (doc_hash, filename, upload_path, total_pages, metadata_json))
-                self.mariadb_connection.commit()
+        # Todo lo que lee del Document (incluido el parseo del PDF al pedir total_pages/metadata)
+        # se hace antes de tomar la conexión: la transacción solo cubre el INSERT
+        doc_hash = document.hash
+        upload_path = document.upload_path
+        filename = document.filename
+        total_pages = document.total_pages
+        metadata_json = json.dumps(document.metadata) if document.metadata else None
+
+        # Insertar el documento en la tabla documents (o actualizar su ruta si ya existe)
+        query = """
+            INSERT INTO documents (doc_hash, filename, upload_path, total_pages, metadata)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), upload_path = VALUES(upload_path)
+        """
+        with self.mariadb_pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, (doc_hash, filename, upload_path, total_pages, metadata_json))
+                    document_id = cursor.lastrowid
+                conn.commit()
+                self.invalidate_document(doc_hash)
                 return {
-                    "document_id": cursor.lastrowid,
+                    "document_id": document_id,
                     "total_pages": total_pages
                 }
-            
-        except Exception as e:
-            self.mariadb_connection.rollback() # Si ocurre un error, revertimos la transacción para mantener la integridad de la base de datos
-            logging.error(f"Error inserting document: {e}")
-            raise e
+
+            except Exception as e:
+                conn.rollback() # Si ocurre un error, revertimos la transacción para mantener la integridad de la base de datos
+                logging.error(f"Error inserting document: {e}")
+                raise e
         
-    def search_pages(self, query_embedding: torch.Tensor, limit: int = 5) -> QResponse:
+    def bulk_insert_pages(self, rows: List[Tuple[int, int, str, Optional[str]]]) -> int:
+        """
+        Inserts (or updates) several pages in a single transaction.
+        PyMySQL's executemany rewrites the INSERT into one multi-row statement,
+        so N pages cost one round-trip to MariaDB instead of N. For very large
+        documents it splits the statement at Cursor.max_stmt_length (~1 MB), which
+        keeps each packet under MariaDB's max_allowed_packet; all pieces share the
+        same transaction and a single commit.
+
+        Args:
+            rows (List[Tuple[int, int, str, Optional[str]]]): Tuples of
+                (document_id, page_number, content, metadata_json).
+        Returns:
+            int: The number of affected rows reported by MariaDB.
+        Raises:
+            Exception: If any error occurs, the transaction is rolled back and the exception is raised.
+        """
+        if not rows:
+            return 0
+        query = """
+            INSERT INTO pages (document_id, page_number, content, metadata)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE content = VALUES(content), metadata = VALUES(metadata)
+        """
+        with self.mariadb_pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    affected = cursor.executemany(query, rows)
+                conn.commit()
+                return affected or 0
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Error inserting pages: {e}")
+                raise e
+
+    def get_pages_tables_text(self, pages: List[Tuple[str, int]]) -> Dict[Tuple[str, int], str]:
+        """
+        Recupera el texto tabular guardado en pages.metadata para un conjunto de páginas,
+        en una sola consulta. Pensado para los top-K resultados de una búsqueda.
+
+        Args:
+            pages (List[Tuple[str, int]]): Pares (doc_hash, page_number).
+        Returns:
+            Dict[Tuple[str, int], str]: tables_text por (doc_hash, page_number). Las páginas
+                sin registro no aparecen en el diccionario.
+        """
+        pages = list(dict.fromkeys(pages)) # Sin duplicados, conservando el orden
+        if not pages:
+            return {}
+        placeholders = ", ".join(["(%s, %s)"] * len(pages))
+        query = f"""
+            SELECT d.doc_hash, p.page_number, JSON_UNQUOTE(JSON_EXTRACT(p.metadata, '$.tables_text'))
+            FROM pages p
+            JOIN documents d ON d.id = p.document_id
+            WHERE (d.doc_hash, p.page_number) IN ({placeholders})
+        """
+        args = [value for page in pages for value in page]
+        with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, args)
+            rows = cursor.fetchall()
+        return {(doc_hash, page_number): tables_text or "" for doc_hash, page_number, tables_text in rows}
+
+    def get_cached_page_vectors(self, page_hashes: List[str]) -> Dict[str, list]:
+        """
+        Busca en la caché de embeddings por página los multivectores ya calculados para estas páginas:
+        una consulta IN a MariaDB y un retrieve a Qdrant con los puntos encontrados.
+        Las entradas cuyo punto ya no existe en Qdrant se ignoran (se recalculan).
+        La caché es solo una optimización: si MariaDB o Qdrant fallan se registra el error y se
+        devuelve {} (todas las páginas cuentan como fallo de caché) en lugar de abortar la ingestión.
+
+        Args:
+            page_hashes (List[str]): Hashes de página (ver Document._render_page).
+        Returns:
+            Dict[str, list]: Multivector [tokens, dim] por page_hash, solo para los aciertos.
+        """
+        page_hashes = tuple(set(page_hashes))
+        if not page_hashes:
+            return {}
+        query = "SELECT page_hash, point_id FROM page_embedding_cache WHERE page_hash IN %s"
+        try:
+            with self.mariadb_pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (page_hashes,))
+                rows = cursor.fetchall()
+            if not rows:
+                return {}
+
+            records = self.qdrant_client.retrieve(
+                collection_name=Config.QDRANT_COLLECTION,
+                ids=list({point_id for _page_hash, point_id in rows}),
+                with_payload=False,
+                with_vectors=["colbert"]
+            )
+        except Exception as e:
+            logging.warning(f"Error reading page embedding cache, computing pages instead: {e}")
+            return {}
+        vectors_by_point = {str(record.id): record.vector["colbert"] for record in records if record.vector}
+        return {
+            page_hash: vectors_by_point[point_id]
+            for page_hash, point_id in rows
+            if point_id in vectors_by_point
+        }
+
+    def cache_page_embeddings(self, rows: List[Tuple[str, str]]) -> None:
+        """
+        Registra en la caché de embeddings por página el punto de Qdrant de cada página.
+        Llamar solo cuando los puntos ya están aplicados en Qdrant (upsert con wait=True).
+        Si la página ya estaba registrada se sustituye su punto: así se reparan las entradas
+        que apuntan a puntos que ya no existen.
+
+        Args:
+            rows (List[Tuple[str, str]]): Pares (page_hash, point_id).
+        """
+        if not rows:
+            return
+        query = """
+            INSERT INTO page_embedding_cache (page_hash, point_id) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE point_id = VALUES(point_id)
+        """
+        with self.mariadb_pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.executemany(query, rows)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Error caching page embeddings: {e}")
+                raise e
+
+    def upsert_points(self, points: List[PointStruct], batch_size: int = 64, wait: bool = False) -> None:
+        """
+        Sube puntos a la colección de Qdrant en lotes de batch_size.
+        Con wait=False Qdrant confirma en cuanto registra la operación (WAL) sin esperar a
+        indexarla, de modo que las siguientes subidas se encadenan sin bloquear.
+        Args:
+            points (List[PointStruct]): Los puntos a subir.
+            batch_size (int): Número máximo de puntos por petición.
+            wait (bool): Si True, espera a que Qdrant aplique cada lote.
+        """
+        for start in range(0, len(points), batch_size):
+            self.qdrant_client.upsert(
+                collection_name=Config.QDRANT_COLLECTION,
+                points=points[start:start + batch_size],
+                wait=wait
+            )
+
+    def search_pages(self, query_embedding: torch.Tensor, limit: int = 5, doc_hash: Optional[str] = None) -> QResponse:
         """
         Realiza una búsqueda en Qdrant utilizando un embedding de consulta y devuelve los resultados más relevantes.
         Args:
             query_embedding (torch.Tensor): El embedding de consulta generado por el modelo ColPali.
             limit (int): El número máximo de resultados a devolver.
+            doc_hash (Optional[str]): Si se indica, restringe la búsqueda a las páginas de ese documento
+                (pre-filtrado mediante el índice de payload `document_hash`).
         Returns:
             QueryResponse: La respuesta de la consulta con los resultados encontrados.
         """
         # 1. Preparar el vector para Qdrant
         # El modelo devuelve un tensor [1, tokens, dim]. 
-        # Debemos quitar la dimensión del batch (squeeze), asegurar float32 y convertir a lista.
-        query_multivector = query_embedding.squeeze(0).cpu().float().numpy().tolist()
+        # Quitamos la dimensión del batch (squeeze) y pasamos un ndarray float32 sin convertir a lista:
+        # qdrant-client lo serializa directamente, sin crear tokens*dim floats de Python.
+        query_multivector = query_embedding.squeeze(0).to(torch.float32).cpu().numpy()
+
+        query_filter = self._document_filter(doc_hash)
 
         # 2. Ejecutar la búsqueda en Qdrant
         # El comparador MAX_SIM configurado en _init_qdrant hará el resto
@@ -247,9 +588,42 @@ class Database:
             collection_name=Config.QDRANT_COLLECTION,
             query=query_multivector,
             using="colbert",  # Debe coincidir con la clave definida en _init_qdrant
-            with_payload=True,
-            limit=limit
+            query_filter=query_filter,
+            with_payload=PayloadSelectorInclude(include=_SEARCH_PAYLOAD_FIELDS),
+            with_vectors=False,
+            limit=limit,
+            search_params=self._search_params()
         )
 
         return search_result
+
+    def search_pages_batch(self, query_embeddings: List[torch.Tensor], limit: int = 5, doc_hash: Optional[str] = None) -> List[QResponse]:
+        """
+        Ejecuta varias búsquedas en una sola petición a Qdrant (query_batch_points).
+        Args:
+            query_embeddings (List[torch.Tensor]): Un embedding [tokens, dim] por consulta.
+            limit (int): El número máximo de resultados por consulta.
+            doc_hash (Optional[str]): Si se indica, restringe todas las consultas a ese documento.
+        Returns:
+            List[QueryResponse]: Una respuesta por consulta, en el mismo orden que query_embeddings.
+        """
+        query_filter = self._document_filter(doc_hash)
+        search_params = self._search_params()
+        requests = [
+            QueryRequest(
+                # Igual que en search_pages: ndarray float32 sin convertir a lista de Python
+                query=embedding.to(torch.float32).cpu().numpy(),
+                using="colbert",
+                filter=query_filter,
+                params=search_params,
+                with_payload=PayloadSelectorInclude(include=_SEARCH_PAYLOAD_FIELDS),
+                with_vector=False,
+                limit=limit
+            )
+            for embedding in query_embeddings
+        ]
+        return self.qdrant_client.query_batch_points(
+            collection_name=Config.QDRANT_COLLECTION,
+            requests=requests
+        )
     
\ No newline at end of file
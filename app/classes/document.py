@@ -1,17 +1,22 @@
+import hashlib
 import logging
 import os
-import hashlib
+import mmap
 import re
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import uuid
-from io import BytesIO
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import fitz  # PyMuPDF
+import numpy as np
 from PIL import Image
 from qdrant_client.models import PointStruct
 
 from app.classes.colpaliModel import ColPaliModel
+from app.config import Config
 from app.helpers.fill_page_number import fill_page_number
+from app.helpers.new_hasher import new_hasher
 
 # --- Heurísticas para captions/paginación (Word -> PDF) ---
 """
@@ -47,22 +52,47 @@ def _norm_ws(s: str) -> str:
         >>> _norm_ws(None)
         ''
     """
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    # str.split() sin argumentos corta por cualquier espacio Unicode (igual que \s) y descarta
+    # los extremos; es bastante más rápido que re.sub + strip para cada bloque.
+    return " ".join((s or "").split())
 
 
 class Document:
-    def __init__(self, upload_path: str):
+    def __init__(self, upload_path: str, precomputed_hash: Optional[str] = None, filename: Optional[str] = None):
         self._validate_path(upload_path)
 
         self.upload_path = os.path.abspath(upload_path)
-        self.hash = self._generate_file_hash()
+        # Nombre original del archivo (el fichero en disco puede llamarse {hash}.pdf)
+        self.filename = filename or os.path.basename(self.upload_path)
+        # Si quien sube el fichero ya calculó el hash mientras lo escribía, no se vuelve a leer
+        self.hash = precomputed_hash or self._generate_file_hash()
 
-        self.doc = fitz.open(self.upload_path)
-        self.total_pages = self.doc.page_count
-        self.metadata = self.doc.metadata
+        # El PDF se abre con PyMuPDF en el primer acceso a doc/total_pages/metadata:
+        # quien solo necesita el hash no paga el parseo del documento
+        self._doc = None
+        self._page_width = None
 
         # Cache para firmas header/footer (se calcula bajo demanda)
         self._hf_sigs = None
+        # Bloques de texto de las páginas muestreadas para las firmas, reutilizados en la extracción
+        self._blocks_cache = {}
+
+    @property
+    def doc(self) -> fitz.Document:
+        if self._doc is None:
+            self._doc = fitz.open(self.upload_path)
+            # Dígitos del número de página en los ids de Qdrant. Se fija al abrir el PDF para que
+            # format_page_number no lea el documento desde el hilo consumidor de iter_points
+            self._page_width = len(str(self._doc.page_count))
+        return self._doc
+
+    @property
+    def total_pages(self) -> int:
+        return self.doc.page_count
+
+    @property
+    def metadata(self) -> dict:
+        return self.doc.metadata
 
     # --- Métodos privados ---
     def _validate_path(self, path: str):
@@ -78,11 +108,13 @@ class Document:
             raise PermissionError(f"Error: Sin permisos de lectura en '{path}'.")
 
     def _generate_file_hash(self) -> str:
-        sha256_hash = hashlib.sha256()
-        with open(self.upload_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(65536), b""):  # 64KB
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+        # El fichero se mapea en memoria y se hashea con una única llamada en C (sin GIL), en lugar
+        # de trocearlo en bloques de 256 KB como hace file_digest: OpenSSL (SHA-NI) o blake3 (SIMD,
+        # multihilo) ven un solo buffer contiguo. _validate_path ya descarta ficheros vacíos.
+        hasher = new_hasher()
+        with open(self.upload_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hasher.update(mm)
+        return hasher.hexdigest()
 
     def _compute_header_footer_signatures(self, sample_pages: int = 12):
         """
@@ -101,7 +133,9 @@ class Document:
             h = page.rect.height
 
             # blocks: (x0, y0, x1, y1, text, block_no, block_type)
-            for (x0, y0, x1, y1, t, *_rest) in page.get_text("blocks"):
+            blocks = page.get_text("blocks")
+            self._blocks_cache[i] = blocks
+            for (x0, y0, x1, y1, t, *_rest) in blocks:
                 txt = _norm_ws(t).lower()
                 if not txt:
                     continue
@@ -136,14 +170,26 @@ class Document:
         captions = []
         table_like = []
 
-        for (x0, y0, x1, y1, t, *_rest) in page.get_text("blocks"):
+        # Evita que PyMuPDF vuelva a analizar las páginas ya leídas al calcular las firmas
+        blocks = self._blocks_cache.pop(page.number, None)
+        if blocks is None:
+            blocks = page.get_text("blocks")
+
+        # Geometría en bloque con numpy: una matriz (N, 4) con las bbox y las máscaras de
+        # franja superior/inferior calculadas de una vez, en lugar de comparar bloque a bloque
+        coords = np.array([b[:4] for b in blocks], dtype=np.float64).reshape(-1, 4)
+        top_mask = (coords[:, 3] <= 0.10 * h).tolist()
+        bottom_mask = (coords[:, 1] >= 0.90 * h).tolist()
+        kept_idx = []
+
+        for i, (x0, y0, x1, y1, t, *_rest) in enumerate(blocks):
             txt = _norm_ws(t)
             if not txt:
                 continue
 
             low = txt.lower()
-            is_top = (y1 <= 0.10 * h)
-            is_bottom = (y0 >= 0.90 * h)
+            is_top = top_mask[i]
+            is_bottom = bottom_mask[i]
 
             # Filtra headers/footers repetidos y paginación típica
             if is_top and low in header_sigs:
@@ -151,8 +197,11 @@ class Document:
             if is_bottom and (low in footer_sigs or _PAGE_NUM_RE.match(txt)):
                 continue
 
+            kept_idx.append(i)
+
             # Captions (Figura/Tabla/Table X: ...)
-            if _CAPTION_RE.match(txt) and len(txt) <= 300:
+            # Se comprueba primero la longitud para no ejecutar la regex sobre bloques largos
+            if len(txt) <= 300 and _CAPTION_RE.match(txt):
                 captions.append(txt)
                 blocks_out.append({"bbox": [x0, y0, x1, y1], "text": txt, "kind": "caption"})
                 continue
@@ -166,8 +215,10 @@ class Document:
             else:
                 blocks_out.append({"bbox": [x0, y0, x1, y1], "text": txt, "kind": "text"})
 
-        # Sin columnas: ordenar por y0, luego x0 suele ir bien
-        blocks_out.sort(key=lambda b: (b["bbox"][1], b["bbox"][0]))
+        # Sin columnas: ordenar por y0, luego x0 suele ir bien (lexsort es estable, como sort)
+        kept = coords[kept_idx]
+        order = np.lexsort((kept[:, 0], kept[:, 1]))
+        blocks_out = [blocks_out[j] for j in order.tolist()]
 
         # Construir text “LLM-friendly” evitando duplicados consecutivos
         parts = []
@@ -187,61 +238,217 @@ class Document:
             "figure_captions": captions,
         }
 
-    # --- Métodos públicos ---
-    def page_to_qdrant(self, page_number: int, model: ColPaliModel) -> PointStruct:
+    def _render_page(self, page: fitz.Page, target_size: Optional[Tuple[int, int]] = None,
+                     with_hash: bool = False) -> Tuple[Image.Image, Optional[str]]:
         """
-        Convierte una página PDF a un PointStruct de Qdrant con embedding multi-vector (ColPali)
-        y payload textual layout-aware (mejor que page.get_text() plano).
-
-        Devuelve:
-          - point_struct: PointStruct listo para upsert en Qdrant
-          - image: bytes PNG de la página renderizada
+        Renderiza una página como imagen PIL en RGB. Con `with_hash` devuelve también el SHA-256 de
+        sus píxeles (clave de la caché de embeddings por página: dos páginas idénticas dan el mismo
+        hash); si no, None.
+        - Por defecto (RENDER_MAX_SIDE=0) directamente al tamaño de entrada del modelo, `target_size`
+          (alto, ancho): el procesador de ColPali redimensiona a ese tamaño sin conservar la proporción,
+          así que MuPDF rasteriza solo los píxeles que se van a usar y el redimensionado de PIL no hace nada.
+        - Con RENDER_MAX_SIDE > 0 (o si el modelo no expone su tamaño), con el lado mayor en esos px.
+        Renderizar a 300 DPI (~2500x3300 px) solo añade coste de rasterizado y de copia.
+        """
+        width, height = page.rect.width, page.rect.height
+        if Config.RENDER_MAX_SIDE <= 0 and target_size:
+            target_height, target_width = target_size
+            mat = fitz.Matrix(target_width / width, target_height / height)
+        else:
+            zoom = (Config.RENDER_MAX_SIDE or 1024) / max(width, height)
+            mat = fitz.Matrix(zoom, zoom)
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+
+        # Sin codificar/decodificar PNG: PIL lee directamente las muestras del pixmap
+        # (csRGB sin alfa: siempre 3 canales)
+        samples = pix.samples
+        page_hash = hashlib.sha256(samples).hexdigest() if with_hash else None
+        image = Image.frombuffer("RGB", (pix.width, pix.height), samples, "raw", "RGB", 0, 1)
+        return image, page_hash
+
+    def _prepare_pages(self, page_numbers: List[int], model: ColPaliModel,
+                       embedding_lookup: Optional[Callable[[List[str]], Dict[str, list]]] = None) -> tuple:
         """
-        if page_number < 0 or page_number >= self.total_pages:
-            raise IndexError("Número de página fuera de rango.")
+        Etapa CPU del procesado de un lote: extracción de texto, renderizado y procesador de ColPali.
+        Si se pasa `embedding_lookup` (page_hash -> multivector ya calculado), las páginas encontradas
+        no pasan por el procesador ni por el modelo.
 
-        page = self.doc[page_number]
+        Devuelve (extracted_pages, page_hashes, cached, inputs): `cached` son los multivectores
+        reutilizados por posición en el lote e `inputs` las entradas del modelo para el resto
+        (None si todas las páginas estaban en caché).
+        """
+        for page_number in page_numbers:
+            if page_number < 0 or page_number >= self.total_pages:
+                raise IndexError("Número de página fuera de rango.")
+
+        extracted_pages = []
+        images = []
+        page_hashes = []
+        for page_number in page_numbers:
+            page = self.doc[page_number]
+            # Extracción de texto robusta para Word->PDF
+            extracted_pages.append(self._extract_payload_text(page))
+            # Sin caché de embeddings no se hashean los píxeles
+            image, page_hash = self._render_page(page, model.image_size, with_hash=embedding_lookup is not None)
+            images.append(image)
+            # El modelo forma parte de la clave: otro checkpoint da otros embeddings
+            page_hashes.append(f"{model.model_name}:{page_hash}" if page_hash else None)
+
+        found = embedding_lookup(page_hashes) if embedding_lookup else {}
+        cached = {i: found[h] for i, h in enumerate(page_hashes) if h in found}
+        missing_images = [image for i, image in enumerate(images) if i not in cached]
+        inputs = model.prepare_pages(missing_images) if missing_images else None
+        return extracted_pages, page_hashes, cached, inputs
+
+    def _launch_pending(self, pending: Tuple[List[int], Future], model: ColPaliModel) -> tuple:
+        """
+        Espera a que el productor termine un lote, lanza el forward y la copia asíncrona
+        de los embeddings a CPU. No bloquea en la GPU: devuelve el lote "en vuelo".
+        """
+        page_numbers, future = pending
+        extracted_pages, page_hashes, cached, inputs = future.result()
+        host_embeddings, ready = None, None
+        if inputs is not None:
+            host_embeddings, ready = model.copy_to_host(model.embed_inputs(inputs))
+        return page_numbers, extracted_pages, page_hashes, cached, host_embeddings, ready
+
+    def _finish_batch(self, in_flight: tuple, device: str) -> Tuple[List[PointStruct], List[dict]]:
+        """Espera a que termine la copia a CPU de un lote en vuelo y construye sus puntos."""
+        page_numbers, extracted_pages, page_hashes, cached, host_embeddings, ready = in_flight
+        if ready is not None:
+            ready.synchronize()
+        # Embeddings recién calculados (en orden) para las páginas que no estaban en caché
+        computed = iter(host_embeddings.numpy()) if host_embeddings is not None else iter(())
+        multivectors = [cached[i] if i in cached else next(computed) for i in range(len(page_numbers))]
+        return self._build_points(page_numbers, extracted_pages, page_hashes, multivectors,
+                                  [i in cached for i in range(len(page_numbers))], device)
+
+    def _build_points(self, page_numbers: List[int], extracted_pages: List[dict], page_hashes: List[str],
+                      multivectors: list, from_cache: List[bool], device: str) -> Tuple[List[PointStruct], List[dict]]:
+        """
+        Construye los PointStruct de un lote a partir del multivector [tokens, dim] de cada página
+        (ndarray en CPU si se acaba de calcular, lista si viene de la caché de embeddings).
 
-        # --- NUEVO: extracción de texto robusta para Word->PDF ---
-        extracted = self._extract_payload_text(page)
+        El payload de Qdrant se mantiene ligero (solo lo que se usa al buscar); los datos
+        voluminosos de cada página (bloques con bbox, tablas) van en un sidecar que se
+        guarda en MariaDB (pages.metadata).
 
-        # Render 300 DPI
-        zoom = 300 / 72
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
+        Devuelve:
+          - points: PointStruct listos para upsert en Qdrant
+          - sidecars: dict por página con page_number, text, blocks, tables_text, device_used,
+            page_hash (None sin caché de embeddings) y from_cache
+        """
+        points = []
+        sidecars = []
+        for i, (page_number, extracted) in enumerate(zip(page_numbers, extracted_pages)):
+            points.append(PointStruct(
+                id=str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{self.hash}_{self.format_page_number(page_number)}")),
+                # PointStruct acepta el ndarray tal cual (pydantic lo convierte al validar)
+                vector={"colbert": multivectors[i]},
+                payload={
+                    "document_hash": self.hash,
+                    "page_number": page_number,
+
+                    # Texto para contexto LLM (limpio y mejor ordenado)
+                    "text": extracted["text"],
+                    "figure_captions": extracted["figure_captions"],
+                },
+            ))
+            sidecars.append({
+                "page_number": page_number,
+                "text": extracted["text"],
+                "blocks": extracted["blocks"],
+                "tables_text": extracted["tables_text"],
+                "device_used": "cache" if from_cache[i] else device,
+                "page_hash": page_hashes[i],
+                "from_cache": from_cache[i],
+            })
 
-        image_data = pix.tobytes("png")
-        image = Image.open(BytesIO(image_data)).convert("RGB")
+        return points, sidecars
 
-        # Embedding ColPali
-        embeddings = model.process_page(image)
-        multivector = embeddings.cpu().float().numpy()[0].tolist()
+    # --- Métodos públicos ---
+    def format_page_number(self, page_number: int) -> str:
+        """
+        Número de página con ceros a la izquierda según el total de páginas del documento.
+        Ejemplo: con 120 páginas, format_page_number(3) -> "003"
+        """
+        if self._page_width is None:
+            self.doc  # Abre el PDF, que fija _page_width
+        return fill_page_number(page_number, width=self._page_width)
 
-        result = PointStruct(
-            id=str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{self.hash}_{fill_page_number(page_number, self.total_pages)}")),
-            vector={"colbert": multivector},
-            payload={
-                "document_hash": self.hash,
-                "page_number": page_number,
+    def page_to_qdrant(self, page_number: int, model: ColPaliModel) -> PointStruct:
+        """
+        Convierte una página PDF a un PointStruct de Qdrant con embedding multi-vector (ColPali)
+        y payload textual layout-aware (mejor que page.get_text() plano).
 
-                # Texto para contexto LLM (limpio y mejor ordenado)
-                "text": extracted["text"],
+        Devuelve:
+          - point_struct: PointStruct listo para upsert en Qdrant
+        """
+        return self.pages_to_qdrant([page_number], model)[0]
 
-                # Extra opcional (muy útil en RAG de informes)
-                "blocks": extracted["blocks"],
-                "tables_text": extracted["tables_text"],
-                "figure_captions": extracted["figure_captions"],
-                "device_used": model.device,
-            },
-        )
+    def pages_to_qdrant(self, page_numbers: List[int], model: ColPaliModel) -> List[PointStruct]:
+        """
+        Convierte un lote de páginas PDF a PointStructs de Qdrant con un único forward de ColPali.
 
-        return result
-        
+        Devuelve:
+          - lista de PointStruct (en el mismo orden que page_numbers) lista para upsert en Qdrant
+        """
+        future = Future()
+        future.set_result(self._prepare_pages(page_numbers, model))
+        points, _sidecars = self._finish_batch(self._launch_pending((page_numbers, future), model), model.device)
+        return points
+
+    def iter_points(self, model: ColPaliModel, batch_size: int, prefetch: int = 2,
+                    embedding_lookup: Optional[Callable[[List[str]], Dict[str, list]]] = None
+                    ) -> Iterator[Tuple[List[PointStruct], List[dict]]]:
+        """
+        Recorre todo el documento en lotes de batch_size páginas y devuelve, lote a lote,
+        los PointStruct listos para upsert en Qdrant junto con los sidecars de cada página
+        (ver _build_points).
+
+        Pipeline productor/consumidor: un hilo productor renderiza, extrae el texto y ejecuta
+        el procesador de hasta `prefetch` lotes por adelantado mientras el hilo llamante ejecuta
+        el forward de ColPali del lote actual. El tiempo total tiende a max(render, embed) en
+        lugar de su suma. Se usa un único hilo productor porque PyMuPDF no es thread-safe
+        sobre un mismo documento.
+
+        En GPU, la copia a CPU de cada lote es asíncrona (memoria fijada): se lanza el forward
+        del lote siguiente antes de esperar a esa copia, así que la única sincronización por
+        lote ocurre cuando la GPU ya tiene trabajo encolado.
+
+        `embedding_lookup` (opcional) recibe los hashes de las páginas de un lote y devuelve los
+        multivectores ya conocidos; esas páginas se reutilizan sin pasar por ColPali.
+        """
+        batches = [
+            list(range(start, min(start + batch_size, self.total_pages)))
+            for start in range(0, self.total_pages, batch_size)
+        ]
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-render")
+        pending = deque()
+        in_flight = None
+        try:
+            for page_numbers in batches:
+                pending.append((page_numbers, pool.submit(self._prepare_pages, page_numbers, model, embedding_lookup)))
+                if len(pending) > prefetch:
+                    launched = self._launch_pending(pending.popleft(), model)
+                    if in_flight is not None:
+                        yield self._finish_batch(in_flight, model.device)
+                    in_flight = launched
+            while pending:
+                launched = self._launch_pending(pending.popleft(), model)
+                if in_flight is not None:
+                    yield self._finish_batch(in_flight, model.device)
+                in_flight = launched
+            if in_flight is not None:
+                yield self._finish_batch(in_flight, model.device)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
     def close(self):
         """Libera el archivo PDF."""
-        if self.doc:
-            self.doc.close()
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
 
     # --- Métodos de contexto ---
     def __enter__(self):
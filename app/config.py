@@ -1,5 +1,7 @@
+import functools
 import logging
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 # Configuración de logging para toda la aplicación
@@ -23,19 +25,53 @@ else:
     print(f"Warning: {env_file} not found. Falling back to default .env file.")
     load_dotenv()
 
-class Config:
+# Algoritmos de deduplicación admitidos: todos dan 64 caracteres hexadecimales (documents.doc_hash VARCHAR(64))
+HASH_ALGORITHMS = ("sha256", "sha256-tree", "blake3")
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """
+    Configuración de la aplicación leída de las variables de entorno una sola vez al importar.
+    Inmutable (frozen) y con __slots__: los valores no se pueden reasignar en tiempo de ejecución.
+    """
     # Configuración de la base de datos y Qdrant
-    MARIADB_HOST = os.getenv("MARIADB_HOST", "localhost")
-    MARIADB_USER = os.getenv("MARIADB_USER", "root")
-    MARIADB_PORT = int(os.getenv("MARIADB_PORT", 3306))
-    MARIADB_PASSWORD = os.getenv("MARIADB_PASSWORD", "")
-    MARIADB_DATABASE = os.getenv("MARIADB_DATABASE", "test_db")
-    QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
-    QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
-    QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "rag_collection") # Nombre de la colección en Qdrant
+    MARIADB_HOST: str = os.getenv("MARIADB_HOST", "localhost")
+    MARIADB_USER: str = os.getenv("MARIADB_USER", "root")
+    MARIADB_PORT: int = int(os.getenv("MARIADB_PORT", 3306))
+    MARIADB_PASSWORD: str = os.getenv("MARIADB_PASSWORD", "")
+    MARIADB_DATABASE: str = os.getenv("MARIADB_DATABASE", "test_db")
+    MARIADB_POOL_MIN: int = int(os.getenv("MARIADB_POOL_MIN", 4)) # Conexiones que el pool abre al arrancar
+    MARIADB_POOL_MAX: int = int(os.getenv("MARIADB_POOL_MAX", 32)) # Máximo de conexiones simultáneas a MariaDB
+    QDRANT_HOST: str = os.getenv("QDRANT_HOST", "localhost")
+    QDRANT_PORT: int = int(os.getenv("QDRANT_PORT", 6333))
+    QDRANT_GRPC_PORT: int = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+    QDRANT_COLLECTION: str = os.getenv("QDRANT_COLLECTION", "rag_collection") # Nombre de la colección en Qdrant
+    QDRANT_TIMEOUT: int = int(os.getenv("QDRANT_TIMEOUT", 30)) # Segundos máximos de espera por petición a Qdrant
 
     # Configuración de la aplicación
-    APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
-    APP_PORT = int(os.getenv("APP_PORT", 8000))
-    DATA_DIR = os.getenv("DATA_DIR", "./data") # Directorio donde se guardarán los PDFs finales
-    TEMP_DIR = os.getenv("TEMP_DIR", "./temp") # Directorio temporal para archivos subidos antes de procesarlos
+    APP_HOST: str = os.getenv("APP_HOST", "0.0.0.0")
+    APP_PORT: int = int(os.getenv("APP_PORT", 8000))
+    DATA_DIR: str = os.getenv("DATA_DIR", "./data") # Directorio donde se guardarán los PDFs finales
+    HASH_ALGORITHM: str = os.getenv("HASH_ALGORITHM", "sha256") # Hash de deduplicación de documentos: sha256, sha256-tree o blake3
+
+    # Configuración del modelo ColPali
+    COLPALI_BATCH_SIZE: int = int(os.getenv("COLPALI_BATCH_SIZE", 0)) # Páginas por forward; 0 = estimar según la VRAM libre
+    COLPALI_QUANTIZATION: str = os.getenv("COLPALI_QUANTIZATION", "bf16") # Cuantización de pesos: bf16 (sin cuantizar), fp8 o int8
+    COLPALI_COMPILE: bool = os.getenv("COLPALI_COMPILE", "false").lower() in ("1", "true", "yes") # torch.compile + CUDA Graphs (solo GPU)
+    PAGE_EMBEDDING_CACHE: bool = os.getenv("PAGE_EMBEDDING_CACHE", "true").lower() in ("1", "true", "yes") # Reutiliza el embedding de páginas idénticas ya ingestadas
+    RENDER_MAX_SIDE: int = int(os.getenv("RENDER_MAX_SIDE", 0)) # Lado mayor (px) al rasterizar cada página; 0 = tamaño de entrada del modelo
+
+    def __post_init__(self):
+        # Un HASH_ALGORITHM erróneo falla al arrancar, no en la primera subida
+        if self.HASH_ALGORITHM.lower() not in HASH_ALGORITHMS:
+            raise ValueError(f"HASH_ALGORITHM '{self.HASH_ALGORITHM}' no válido: usa uno de {', '.join(HASH_ALGORITHMS)}")
+
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> Settings:
+    """Devuelve la instancia única de la configuración."""
+    return Settings()
+
+
+# Instancia compartida: el resto de módulos usan `from app.config import Config` y `Config.X`
+Config = get_config()
@@ -1,5 +1,5 @@
 import re
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
 # Palabras clave (ES/EN) para decidir si priorizar tablas/números o figuras
 _NUMERIC_HINTS = re.compile(
@@ -39,33 +39,58 @@ _TABLE_HINTS = re.compile(
 
 _HAS_NUMBER = re.compile(r"\d")
 
-
-def _is_numeric_question(q: str) -> bool:
-    q = q or ""
-    return bool(_NUMERIC_HINTS.search(q) or _HAS_NUMBER.search(q))
+# Las cuatro pistas en una sola alternancia con grupos con nombre: la pregunta se recorre
+# una vez en lugar de hasta tres búsquedas separadas.
+_COMBINED_HINTS = re.compile(
+    "|".join([
+        f"(?P<num>{_NUMERIC_HINTS.pattern})",
+        f"(?P<fig>{_FIGURE_HINTS.pattern})",
+        f"(?P<tbl>{_TABLE_HINTS.pattern})",
+        f"(?P<digit>{_HAS_NUMBER.pattern})",
+    ]),
+    re.IGNORECASE
+)
 
 
-def _wants_figures(q: str) -> bool:
-    q = q or ""
-    return bool(_FIGURE_HINTS.search(q))
+# Separador y cabeceras de sección, definidos una sola vez a nivel de módulo
+_SEP = "\n\n---\n\n"
+_H_TABLES = "TABLAS:\n"
+_H_TABLES_LOW = "TABLAS (baja prioridad):\n"
+_H_CAPTIONS = "FIGURAS / CAPTIONS:\n"
+_H_TEXT = "TEXTO:\n"
 
 
-def _wants_tables(q: str) -> bool:
-    q = q or ""
-    return bool(_TABLE_HINTS.search(q) or _is_numeric_question(q))
+def _classify(q: str) -> Tuple[bool, bool]:
+    """
+    Devuelve (wants_tables, wants_figures) para la pregunta en una sola pasada.
+    - wants_tables: pide tablas o cifras (palabras clave numéricas/tabulares o algún dígito).
+    - wants_figures: menciona figuras, gráficos, imágenes o diagramas.
+    """
+    wants_tables = False
+    wants_figures = False
+    for m in _COMBINED_HINTS.finditer(q or ""):
+        if m.lastgroup == "fig":
+            wants_figures = True
+        else:
+            wants_tables = True
+        if wants_tables and wants_figures:
+            break
+    return wants_tables, wants_figures
 
 
 def _clip(text: str, max_chars: int) -> str:
+    # strip() devuelve el mismo objeto si no hay nada que quitar (las entradas ya llegan limpias)
     text = (text or "").strip()
     if len(text) <= max_chars:
         return text
     # recorte suave en límite de frase / salto
+    min_cut = int(max_chars * 0.6)
     cut = text.rfind("\n", 0, max_chars)
-    if cut < int(max_chars * 0.6):
+    if cut < min_cut:
         cut = text.rfind(". ", 0, max_chars)
-    if cut < int(max_chars * 0.6):
+    if cut < min_cut:
         cut = max_chars
-    return text[:cut].rstrip() + "…"
+    return f"{text[:cut].rstrip()}…"
 
 
 def build_llm_context(payload: Dict[str, Any], question: str,
@@ -96,8 +121,7 @@ def build_llm_context(payload: Dict[str, Any], question: str,
     doc_hash = payload.get("document_hash", None)
     weird = payload.get("table_weirdness", None)
 
-    wants_tables = _wants_tables(question)
-    wants_figures = _wants_figures(question)
+    wants_tables, wants_figures = _classify(question)
 
     # Si el score sugiere tabla problemática, aún más razón para priorizar tablas_text (si existe)
     # (porque suele venir de extractor mejor / o al menos es el contenido numérico concentrado)
@@ -114,7 +138,7 @@ def build_llm_context(payload: Dict[str, Any], question: str,
     if doc_hash:
         meta_bits.append(f"Doc: {str(doc_hash)[:12]}")
     if meta_bits:
-        sections.append("[" + " | ".join(meta_bits) + "]")
+        sections.append(f"[{' | '.join(meta_bits)}]")
 
     # Prioridad:
     # - Si piden cifras/tablas: TABLAS -> CAPTIONS -> TEXTO
@@ -122,28 +146,30 @@ def build_llm_context(payload: Dict[str, Any], question: str,
     # - Si general: TEXTO -> CAPTIONS -> TABLAS (si hay)
     if wants_figures and not wants_tables:
         if captions:
-            sections.append("FIGURAS / CAPTIONS:\n" + _clip(captions, max_caption_chars))
+            sections.append(f"{_H_CAPTIONS}{_clip(captions, max_caption_chars)}")
         if text:
-            sections.append("TEXTO:\n" + _clip(text, max_text_chars))
+            sections.append(f"{_H_TEXT}{_clip(text, max_text_chars)}")
         # añade tablas si existen pero en baja prioridad
         if tables_text:
-            sections.append("TABLAS (baja prioridad):\n" + _clip(tables_text, max_table_chars))
+            sections.append(f"{_H_TABLES_LOW}{_clip(tables_text, max_table_chars)}")
     elif wants_tables:
         if tables_text:
-            sections.append("TABLAS:\n" + _clip(tables_text, max_table_chars))
+            sections.append(f"{_H_TABLES}{_clip(tables_text, max_table_chars)}")
         if captions:
-            sections.append("FIGURAS / CAPTIONS:\n" + _clip(captions, max_caption_chars))
+            sections.append(f"{_H_CAPTIONS}{_clip(captions, max_caption_chars)}")
         if text:
-            sections.append("TEXTO:\n" + _clip(text, max_text_chars))
+            sections.append(f"{_H_TEXT}{_clip(text, max_text_chars)}")
     else:
         if text:
-            sections.append("TEXTO:\n" + _clip(text, max_text_chars))
+            sections.append(f"{_H_TEXT}{_clip(text, max_text_chars)}")
         if captions:
-            sections.append("FIGURAS / CAPTIONS:\n" + _clip(captions, max_caption_chars))
+            sections.append(f"{_H_CAPTIONS}{_clip(captions, max_caption_chars)}")
         if tables_text:
-            sections.append("TABLAS:\n" + _clip(tables_text, max_table_chars))
+            sections.append(f"{_H_TABLES}{_clip(tables_text, max_table_chars)}")
 
-    context = "\n\n---\n\n".join([s for s in sections if s.strip()]).strip()
+    # Cada sección lleva cabecera y contenido ya recortado: nunca está vacía ni tiene espacios
+    # en los extremos, así que se unen directamente sin filtrar ni volver a hacer strip
+    context = _SEP.join(sections)
 
     # Recorte final duro si hace falta
     return _clip(context, max_chars)
\ No newline at end of file
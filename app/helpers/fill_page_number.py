@@ -1,9 +1,15 @@
-def fill_page_number(page: int, total_pages: int) -> str:
+from typing import Optional
+
+
+def fill_page_number(page: int, total_pages: Optional[int] = None, width: Optional[int] = None) -> str:
     """
     Devuelve un string con el numero de página formateado con los ceros necesarios para mantener un orden lexicográfico correcto.
     Ejemplo: fill_page_number(3, 120) -> "003"
+    En bucles por página conviene pasar `width` (len(str(total_pages))) ya calculado, o usar
+    Document.format_page_number, para no convertir total_pages a str en cada llamada.
     """
-    if total_pages is None:
-        return str(page)
-    total_digits = len(str(total_pages))
-    return str(page).zfill(total_digits)
\ No newline at end of file
+    if width is None:
+        if total_pages is None:
+            return str(page)
+        width = len(str(total_pages))
+    return f"{page:0{width}d}"
@@ -0,0 +1,26 @@
+import hashlib
+from typing import Optional
+
+from app.config import Config, HASH_ALGORITHMS
+from app.helpers.tree_hash import TreeSha256
+
+
+def new_hasher(algorithm: Optional[str] = None):
+    """
+    Devuelve un objeto hash nuevo (con update/hexdigest) para el algoritmo de deduplicación de documentos.
+    - "sha256" (por defecto): hashlib/OpenSSL, usa SHA-NI si la CPU lo soporta.
+    - "blake3": hash en árbol con SIMD (AVX2/AVX-512/NEON), varias veces más rápido; requiere el paquete `blake3`.
+    - "sha256-tree": SHA-256 en árbol por bloques de 8 MB hasheados en paralelo (TreeSha256), sin dependencias.
+    Los tres producen 64 caracteres hexadecimales, por lo que caben en documents.doc_hash VARCHAR(64).
+    Cualquier otro algoritmo lanza ValueError.
+    Ejemplo: new_hasher("sha256").hexdigest() -> "e3b0c442..."
+    """
+    algorithm = (algorithm or Config.HASH_ALGORITHM).lower()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Algoritmo de hash no válido: '{algorithm}' (usa uno de {', '.join(HASH_ALGORITHMS)})")
+    if algorithm == "blake3":
+        import blake3 # Dependencia opcional (extra `fast-hash`)
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    if algorithm == "sha256-tree":
+        return TreeSha256()
+    return hashlib.sha256()
@@ -0,0 +1,64 @@
+import io
+import os
+import shutil
+from pathlib import Path
+from typing import BinaryIO
+
+from app.helpers.new_hasher import new_hasher
+
+_COPY_CHUNK = 1024 * 1024 # 1 MB por lectura (shutil.copyfileobj usa 64 KB por defecto)
+
+
+def hash_upload(src: BinaryIO) -> str:
+    """
+    Calcula el hash de deduplicación de un fichero subido (UploadFile.file) leyéndolo en bloques
+    de 1 MB desde la posición actual, sin escribir nada en disco, y vuelve a dejarlo en esa posición
+    para poder guardarlo después con save_upload. Devuelve el hash en hexadecimal (mismo algoritmo que Document).
+    Ejemplo: hash_upload(file.file) -> "9f86d081..."
+    """
+    start = src.tell()
+    hasher = new_hasher()
+    while chunk := src.read(_COPY_CHUNK):
+        hasher.update(chunk)
+    src.seek(start)
+    return hasher.hexdigest()
+
+
+def _real_fileno(src: BinaryIO):
+    # UploadFile.file es un SpooledTemporaryFile: mientras está en memoria (BytesIO) no tiene
+    # descriptor, y llamar a su fileno() lo volcaría a disco. Se mira el fichero interno.
+    raw = getattr(src, "_file", src)
+    try:
+        return raw.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def save_upload(src: BinaryIO, dest: Path) -> None:
+    """
+    Copia el contenido de un fichero subido (UploadFile.file) a `dest`, desde su posición actual.
+    Si el origen es un fichero real en disco se copia con os.sendfile (el kernel mueve los datos
+    sin pasar por buffers de Python); si está en memoria, o sendfile no está disponible, en bloques de 1 MB.
+    Ejemplo: save_upload(file.file, Path("./data/.abc.part"))
+    """
+    start = src.tell()
+    src_fd = _real_fileno(src)
+    with dest.open("wb") as buffer:
+        if src_fd is not None:
+            src.flush() # Lo que quede en el buffer de Python tiene que estar en el descriptor
+            remaining = os.fstat(src_fd).st_size - start
+            offset = start
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(buffer.fileno(), src_fd, offset, remaining)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError:
+                # sendfile no soportado entre estos ficheros: se rehace la copia en espacio de usuario
+                buffer.seek(0)
+                buffer.truncate()
+                src.seek(start)
+        shutil.copyfileobj(src, buffer, _COPY_CHUNK)
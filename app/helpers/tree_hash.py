@@ -0,0 +1,68 @@
+import functools
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+# Tamaño de bloque del árbol. Forma parte de la definición del hash: si cambia, cambian todos
+# los hashes y la deduplicación contra documents.doc_hash deja de reconocer los ya ingestados.
+TREE_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+@functools.lru_cache(maxsize=1)
+def _get_executor() -> ThreadPoolExecutor:
+    # Pool compartido por todos los hashers: hashlib suelta el GIL, los bloques se hashean en paralelo
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="tree-hash")
+
+
+def _block_digest(block) -> bytes:
+    return hashlib.sha256(block).digest()
+
+
+class TreeSha256:
+    """
+    Hash SHA-256 en árbol de dos niveles: sha256(sha256(bloque_0) || sha256(bloque_1) || ...),
+    con bloques de TREE_BLOCK_SIZE. Los bloques se hashean en paralelo en un pool de hilos.
+    Misma interfaz que hashlib (update/hexdigest), así que sirve tanto para subidas en streaming
+    (save_upload) como para un fichero mapeado en memoria (Document).
+    Ejemplo: h = TreeSha256(); h.update(b"abc"); h.hexdigest() -> 64 caracteres hexadecimales
+    """
+    def __init__(self):
+        self._futures: List[Future] = []
+        self._pending = bytearray()
+        self._hexdigest = None
+
+    def update(self, data) -> None:
+        view = memoryview(data).cast("B")
+        offset = 0
+        # Completar primero el bloque que quedó a medias en la llamada anterior
+        if self._pending:
+            take = min(TREE_BLOCK_SIZE - len(self._pending), len(view))
+            self._pending += view[:take]
+            offset = take
+            if len(self._pending) == TREE_BLOCK_SIZE:
+                self._futures.append(_get_executor().submit(_block_digest, bytes(self._pending)))
+                self._pending.clear()
+
+        # Bloques completos directamente sobre el buffer del llamante (sin copiarlos). Hay que
+        # esperarlos antes de volver: el llamante puede liberar el buffer (p. ej. cerrar el mmap)
+        borrowed = []
+        while len(view) - offset >= TREE_BLOCK_SIZE:
+            borrowed.append(_get_executor().submit(_block_digest, view[offset:offset + TREE_BLOCK_SIZE]))
+            offset += TREE_BLOCK_SIZE
+        for future in borrowed:
+            future.result()
+        self._futures.extend(borrowed)
+
+        if offset < len(view):
+            self._pending += view[offset:]
+
+    def hexdigest(self) -> str:
+        if self._hexdigest is None:
+            if self._pending or not self._futures:
+                self._futures.append(_get_executor().submit(_block_digest, bytes(self._pending)))
+                self._pending.clear()
+            digests = b"".join(future.result() for future in self._futures)
+            self._hexdigest = hashlib.sha256(digests).hexdigest()
+        return self._hexdigest
+
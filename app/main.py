@@ -10,15 +10,18 @@ from app.classes.document import Document
 from app.classes.database import Database
 from app.services.ingestion import IngestionService
 from app.classes.colpaliModel import ColPaliModel
+from app.helpers.save_upload import hash_upload, save_upload
 
 # librerias python
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os
-import shutil
+import uuid
 from pathlib import Path
 import time
-from typing import List, Optional
+from typing import Annotated, List, Optional, Tuple, Union
 import uvicorn
 
 
@@ -26,12 +29,14 @@ logger = logging.getLogger(__name__)
 logger.warning("Aplicación iniciada. Los logs se están escribiendo en rag_system.log")
 
 # Directorios
-TEMP_DIR = Path(Config.TEMP_DIR)
 DATA_DIR = Path(Config.DATA_DIR)
-# Asegurar que existan las carpetas
-TEMP_DIR.mkdir(parents=True, exist_ok=True)
+# Asegurar que exista la carpeta
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+# Un único hilo para todas las ingestas: usan el mismo modelo ColPali (y la misma GPU), y los
+# CUDA Graphs de torch.compile (COLPALI_COMPILE) son por hilo, así que se capturan una sola vez
+_ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="colpali-ingest")
+
 # 1. Definimos un diccionario global o contenedor para los recursos pesados
 app_resources = {}
 # 2. Creamos el gestor del ciclo de vida
@@ -53,6 +58,7 @@ async def lifespan(app: FastAPI):
     
     # --- CÓDIGO AL CERRAR ---
     print("Liberando recursos...")
+    _ingest_executor.shutdown(wait=True)
     if "model" in app_resources:
         app_resources["model"].close() #
     print("Recursos liberados.")
@@ -63,8 +69,10 @@ app = FastAPI(lifespan=lifespan)
 
 # --- Modelos de Datos (Pydantic) ---
 class SearchQuery(BaseModel):
-    text: str
+    # Una lista de preguntas se resuelve en una sola petición a Qdrant (vacía -> 422, no llega al modelo)
+    text: Union[str, Annotated[List[str], Field(min_length=1)]]
     limit: Optional[int] = 5
+    document_hash: Optional[str] = None # Si se indica, busca solo dentro de ese documento
 
 class SearchResult(BaseModel):
     page_number: int
@@ -97,55 +105,153 @@ class SearchResponse(BaseModel):
     """
 )
 async def upload_pdfs(files: List[UploadFile] = File(...)):
-    results = []
     inicio_total = time.perf_counter()
     model = app_resources.get("model")
     if not model:
         raise HTTPException(status_code=500, detail="Modelo no disponible")
 
     ingestion_service = IngestionService(app_resources["db"])
-    for file in files:
-        inicio = time.perf_counter()
-        if not file.filename or not file.filename.lower().endswith(".pdf"):
+    # Los archivos se guardan y hashean en paralelo; el bucle de eventos queda libre para el resto de rutas
+    results = await asyncio.gather(*(_process_upload(file, ingestion_service, model) for file in files))
+    fin_total = time.perf_counter()
+    return {"total_processing_time": f"{fin_total - inicio_total:.6f}","results": results }
+
+async def _process_upload(file: UploadFile, ingestion_service: IngestionService, model: ColPaliModel) -> dict:
+    """
+    Guarda, deduplica e ingesta un PDF subido. El guardado y el hash van en el pool por defecto
+    (asyncio.to_thread) y la ingestión en el hilo dedicado _ingest_executor.
+    """
+    inicio = time.perf_counter()
+    if not file.filename or not file.filename.lower().endswith(".pdf"):
+        fin = time.perf_counter()
+        logging.warning(f"Archivo {file.filename} no es un PDF. Tiempo de validación: {fin - inicio:.6f}s")
+        return {
+            "filename": file.filename,
+            "error": "El archivo no es un PDF",
+            "processing_time": f"{fin - inicio:.6f}"
+        }
+
+    try:
+        file_hash, final_path, already_indexed = await asyncio.to_thread(_store_upload, file)
+        if already_indexed:
             fin = time.perf_counter()
-            logging.warning(f"Archivo {file.filename} no es un PDF. Tiempo de validación: {fin - inicio:.6f}s")
-            results.append(
-                {
-                    "filename": file.filename,
-                    "error": "El archivo no es un PDF",
-                    "processing_time": f"{fin - inicio:.6f}"
-                }
-            )
-            continue
+            return {
+                "status": "ya_procesado",
+                "hash": file_hash,
+                "message": "El documento ya fue procesado anteriormente.",
+                "processing_time": f"{fin - inicio:.6f}"
+            }
+
+        # El modelo y la GPU se comparten: las ingestas van de una en una, siempre en el mismo hilo.
+        # IngestionService vuelve a comprobar ahí si el documento ya está indexado, para que dos
+        # subidas simultáneas del mismo PDF no lo ingesten dos veces
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            _ingest_executor, _ingest_upload, final_path, file_hash, Path(file.filename).name, ingestion_service, model
+        )
+        fin = time.perf_counter()
+        return {**result, "processing_time": f"{fin - inicio:.6f}"}
+    except Exception as e:
+        logging.error(f"Error en el upload/db: {e}")
+        fin = time.perf_counter()
+        return {"filename": file.filename, "error": str(e), "processing_time": f"{fin - inicio:.6f}"}
+
+def _store_upload(file: UploadFile) -> Tuple[str, Path, bool]:
+    """
+    Calcula el hash del PDF subido y lo guarda en DATA_DIR/{hash}.pdf si aún no existe.
+    Devuelve (hash, ruta definitiva, True si el documento ya estaba guardado e indexado).
+    """
+    # El hash se calcula sobre el fichero subido antes de escribir nada en disco: una resubida
+    # de un documento ya indexado no escribe ni mueve ningún byte
+    file_hash = hash_upload(file.file)
+    final_path = DATA_DIR / f"{file_hash}.pdf"
 
-        temp_path = TEMP_DIR / file.filename
+    # Documento ya guardado e indexado: no hace falta abrirlo con PyMuPDF
+    existing_doc = app_resources["db"].get_document_by_hash(file_hash)
+    if existing_doc and existing_doc.indexed_in_qdrant and final_path.exists():
+        return file_hash, final_path, True
+
+    if not final_path.exists():
+        # El fichero parcial se escribe en DATA_DIR (mismo sistema de ficheros que el definitivo),
+        # así os.replace es un rename atómico que nunca copia. Nombre único por subida: dos
+        # subidas simultáneas del mismo PDF no se pisan
+        temp_path = DATA_DIR / f".{file_hash}.{uuid.uuid4().hex}.part"
         try:
-            with temp_path.open("wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-
-            with Document(str(temp_path)) as doc:
-                file_hash = doc.hash
-                final_path = DATA_DIR / f"{file_hash}.pdf"
-                if final_path.exists():
-                    os.remove(temp_path)
-                else:
-                    shutil.move(str(temp_path), str(final_path))
-                result = ingestion_service.ingest_document(doc, model=model)
-                fin = time.perf_counter()
-                results.append({**result, "processing_time": f"{fin - inicio:.6f}"})
-        except Exception as e:
-            if temp_path.exists():
-                os.remove(temp_path)
-            logging.error(f"Error en el upload/db: {e}")
-            fin = time.perf_counter()
-            results.append({"filename": file.filename, "error": str(e), "processing_time": f"{fin - inicio:.6f}"})
-    fin_total = time.perf_counter()
-    return {"total_processing_time": f"{fin_total - inicio_total:.6f}","results": results }
+            save_upload(file.file, temp_path)
+            os.replace(temp_path, final_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+    return file_hash, final_path, False
+
+def _ingest_upload(final_path: Path, file_hash: str, filename: str,
+                   ingestion_service: IngestionService, model: ColPaliModel) -> dict:
+    """Ingesta un PDF ya guardado. Se ejecuta en _ingest_executor."""
+    # PyMuPDF abre el PDF ya en su ruta definitiva (Document lo abre de forma perezosa)
+    with Document(str(final_path), precomputed_hash=file_hash, filename=filename) as doc:
+        return ingestion_service.ingest_document(doc, model=model)
 
-@app.post("/search", response_model=SearchResponse)
+def _build_search_response(query_text: str, points, tables_by_page: dict, documents_by_hash: dict) -> SearchResponse:
+    """
+    Construye la SearchResponse de una consulta a partir de sus puntos de Qdrant
+    y de los datos de MariaDB ya leídos (tablas y documentos).
+    """
+    final_results = []
+    context_blocks = []
+
+    for hit in points:
+        p = hit.payload
+        if not p:
+            logging.warning(f"Resultado sin payload encontrado: {hit.id}")
+            continue
+        # Extraemos datos del payload
+        document_hash = p.get("document_hash", "Documento desconocido")
+        doc = documents_by_hash.get(document_hash)
+        filename = doc.filename if doc else "Archivo desconocido"
+        page_num = p.get("page_number", -1) # Si no se encuentra el número de página, se asigna -1 para indicar que es desconocido
+        text_content = p.get("text", "")
+        tables = tables_by_page.get((document_hash, page_num), "")
+        captions = p.get("figure_captions", "")
+
+        # Creamos el bloque de contexto para esta página
+        block_parts = [f"--- FUENTE: {filename} (Página {page_num}) ---\n"]
+
+        if text_content:
+            block_parts.append(f"[CONTENIDO TEXTUAL]:\n{text_content}")
+
+        if tables:
+            block_parts.append(f"[DATOS TABULARES DETECTADOS]:\n{tables}")
+        
+        if captions:
+            # Unimos las capturas de figuras/tablas para dar contexto visual (un solo join, sin string intermedio)
+            block_parts.append("\n- ".join(["[ILUSTRACIONES Y FIGURAS EN ESTA PÁGINA]:", *captions]))
+        
+        block = "\n\n".join(block_parts)
+        context_blocks.append(block)
+
+        final_results.append(SearchResult(
+            page_number=page_num,
+            document_hash=document_hash,
+            filename=filename,
+            score=hit.score,
+            content=text_content,
+            formated_context=block
+        ))
+    
+    # Unimos todo en un solo string para el LLM
+    full_context = "\n".join(context_blocks)
+    
+    return SearchResponse(
+        query=query_text,
+        results=final_results,
+        full_prompt_context=full_context
+    )
+
+@app.post("/search", response_model=Union[SearchResponse, List[SearchResponse]])
 async def search(query: SearchQuery):
     """
     Endpoint para realizar búsquedas semánticas en los documentos indexados.
+    Si `text` es una lista, todas las consultas se resuelven con una sola petición a Qdrant
+    y se devuelve una SearchResponse por consulta, en el mismo orden.
     """
     model = app_resources.get("model")
     if not model:
@@ -154,61 +260,37 @@ async def search(query: SearchQuery):
     if not db:
         raise HTTPException(status_code=500, detail="Base de datos no disponible")
     try:
-        query_embedding = model.process_text(query.text)
-        search_results = db.search_pages(query_embedding, limit=query.limit or 5) # si limit es None, se usará 5 por defecto
-
-        final_results = []
-        context_blocks = []
-
-        for hit in search_results.points:
-            p = hit.payload
-            if not p:
-                logging.warning(f"Resultado sin payload encontrado: {hit.id}")
-                continue
-            # Extraemos datos del payload
-            # Nota: Asegúrate de guardar 'filename' en el payload al indexar
-            document_hash = p.get("document_hash", "Documento desconocido")
-            doc = db.get_document_by_hash(document_hash) if document_hash != "Documento desconocido" else None
-            filename = doc.filename if doc else "Archivo desconocido"
-            page_num = p.get("page_number", -1) # Si no se encuentra el número de página, se asigna -1 para indicar que es desconocido
-            text_content = p.get("text", "")
-            tables = p.get("tables_text", "")
-            captions = p.get("figure_captions", "")
-
-            # Creamos el bloque de contexto para esta página
-            block_parts = [f"--- FUENTE: {filename} (Página {page_num}) ---\n"]
-
-            if text_content:
-                block_parts.append(f"[CONTENIDO TEXTUAL]:\n{text_content}")
-
-            if tables:
-                block_parts.append(f"[DATOS TABULARES DETECTADOS]:\n{tables}")
-            
-            if captions:
-                # Unimos las capturas de figuras/tablas para dar contexto visual
-                captions_str = "\n- ".join(captions)
-                block_parts.append(f"[ILUSTRACIONES Y FIGURAS EN ESTA PÁGINA]:\n- {captions_str}")
-            
-            block = "\n\n".join(block_parts)
-            context_blocks.append(block)
-
-            final_results.append(SearchResult(
-                page_number=page_num,
-                document_hash=document_hash,
-                filename=filename,
-                score=hit.score,
-                content=text_content,
-                formated_context=block
-            ))
-        
-        # Unimos todo en un solo string para el LLM
-        full_context = "\n".join(context_blocks)
-        
-        return SearchResponse(
-            query=query.text,
-            results=final_results,
-            full_prompt_context=full_context
+        limit = query.limit or 5 # si limit es None, se usará 5 por defecto
+        if isinstance(query.text, list):
+            query_texts = query.text
+            query_embeddings = model.process_text_batch(query_texts)
+            responses = db.search_pages_batch(query_embeddings, limit=limit, doc_hash=query.document_hash)
+        else:
+            query_texts = [query.text]
+            query_embedding = model.process_text(query.text)
+            responses = [db.search_pages(query_embedding, limit=limit, doc_hash=query.document_hash)]
+
+        all_points = [hit for response in responses for hit in response.points]
+
+        # Las tablas no viajan en el payload de Qdrant: se leen de MariaDB solo para los top-K
+        tables_by_page = db.get_pages_tables_text([
+            (hit.payload["document_hash"], hit.payload["page_number"])
+            for hit in all_points
+            if hit.payload and "document_hash" in hit.payload and "page_number" in hit.payload
+        ])
+
+        # Una sola consulta para los documentos de todos los resultados (en lugar de una por resultado)
+        documents_by_hash = db.get_documents_by_hashes(
+            hit.payload["document_hash"]
+            for hit in all_points
+            if hit.payload and "document_hash" in hit.payload
         )
+
+        search_responses = [
+            _build_search_response(query_text, response.points, tables_by_page, documents_by_hash)
+            for query_text, response in zip(query_texts, responses)
+        ]
+        return search_responses if isinstance(query.text, list) else search_responses[0]
     except Exception as e:
         logging.error(f"Error en la búsqueda: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,10 +1,10 @@
+import json
 from pathlib import Path
 
 from app.classes.document import Document
 from app.classes.database import Database
 from app.classes.colpaliModel import ColPaliModel
 from app.config import Config
-from app.helpers.fill_page_number import fill_page_number
 
 class IngestionService:
     """
@@ -34,34 +34,61 @@ class IngestionService:
             Exception: If any error occurs during the ingestion process, an exception is raised with details.
         """
         try:
-            # Verificar si el documento ya existe en MariaDB
-            existing_doc = self.db.get_document_by_hash(doc.hash)
-            if existing_doc:
-                # Si el documento ya existe, actualizar la ruta si es necesario y retornar información
+            # Atajo: si el documento ya está indexado no hay nada que ingestar. Se lee directamente
+            # de MariaDB (sin la caché LRU): esta comprobación decide si se escribe, y es la que
+            # evita que dos subidas simultáneas del mismo PDF lo ingesten dos veces
+            existing_doc = self.db.get_document_by_hash(doc.hash, use_cache=False)
+            if existing_doc and existing_doc.indexed_in_qdrant:
+                # Actualizar la ruta si es necesario y retornar información
                 if existing_doc.upload_path != doc.upload_path:
                     self.db.update_document_path(doc.hash, doc.upload_path)
-                # Comprobar si el documento ya ha sido procesado y salir temprano si es así
-                if existing_doc.indexed_in_qdrant:
-                    return {
-                        "status": "ya_procesado",
-                        "hash": doc.hash,
-                        "message": "El documento ya fue procesado anteriormente."
-                    }
-                
-                
-            else: # Si no existe, insertar nuevo registro en base de datos
-                new_doc_id = self.db.insert_document(doc)
+                return {
+                    "status": "ya_procesado",
+                    "hash": doc.hash,
+                    "message": "El documento ya fue procesado anteriormente."
+                }
+
+            # Un único upsert: crea el registro o, si ya existía sin indexar, actualiza su ruta
+            # y devuelve el mismo id
+            document_id = self.db.insert_document(doc)["document_id"]
 
             # Procesar el documento y agregar embeddings a Qdrant
-            qdrant_client = self.db.get_qdrant_client()
-            for n_page in range(doc.total_pages):
-                page_result = doc.page_to_qdrant(n_page, model=model)
-                point = page_result
-                # Subir el punto a Qdrant inmediatamente
-                qdrant_client.upsert(
-                    collection_name=Config.QDRANT_COLLECTION,
-                    points=[point]
-                )
+            # El renderizado de los siguientes lotes se solapa con el forward del lote actual
+            pending_points = []
+            # Entradas nuevas de la caché de embeddings; se registran cuando sus puntos ya están en Qdrant
+            page_cache_rows = []
+            # Páginas idénticas a otras ya ingestadas reutilizan su embedding sin pasar por ColPali
+            embedding_lookup = self.db.get_cached_page_vectors if Config.PAGE_EMBEDDING_CACHE else None
+            for points, sidecars in doc.iter_points(model=model, batch_size=model.batch_size,
+                                                    embedding_lookup=embedding_lookup):
+                # Subir los puntos del lote anterior a Qdrant sin esperar a que se indexen; el último
+                # lote se guarda para subirlo con wait=True
+                if pending_points:
+                    self.db.upsert_points(pending_points)
+                pending_points = points
+                # Guardar texto y metadatos voluminosos de las páginas del lote en MariaDB con un único INSERT
+                self.db.bulk_insert_pages([
+                    (
+                        document_id,
+                        sidecar["page_number"],
+                        sidecar["text"],
+                        json.dumps({k: sidecar[k] for k in ("blocks", "tables_text", "device_used")}),
+                    )
+                    for sidecar in sidecars
+                ])
+                if Config.PAGE_EMBEDDING_CACHE:
+                    page_cache_rows.extend(
+                        (sidecar["page_hash"], point.id)
+                        for point, sidecar in zip(points, sidecars)
+                        if not sidecar["from_cache"]
+                    )
+            # Qdrant aplica las operaciones en orden: esperar al último lote garantiza que todos los
+            # anteriores están aplicados antes de marcar el documento como indexado
+            if pending_points:
+                self.db.upsert_points(pending_points, wait=True)
+            # Solo ahora todos los puntos existen en Qdrant: si la ingestión falla antes, la caché
+            # no queda apuntando a puntos que nunca se subieron
+            self.db.cache_page_embeddings(page_cache_rows)
             # Marcar el documento como indexado en Qdrant
             self.db.mark_document_indexed(doc.hash)
 
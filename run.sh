@@ -14,7 +14,7 @@ else
 fi
 
 # 2. Crear carpetas necesarias si no existen
-mkdir -p data temp
+mkdir -p data
 
 # 3. Lanzar el servidor
 echo "[*] Arrancando API RAG en http://localhost:8000"
@@ -1,9 +1,12 @@
 
-import requests
+import asyncio
 import os
 
+import httpx
+
 url = "http://localhost:8000/upload-pdfs/"
 folder_path = "/home/jvdura/RAG-MariaDb-Qdrant/docs_prueba/"
+max_concurrent = 8 # Subidas simultáneas como máximo (y ficheros abiertos a la vez)
 
 # Listar todos los archivos PDF en folder_path
 pdf_files = [
@@ -16,15 +19,31 @@ if not pdf_files:
 	print("No se encontraron archivos PDF en la carpeta.")
 	exit(1)
 
-# Preparar los archivos para multipart/form-data
-files = [("files", (os.path.basename(f), open(f, "rb"), "application/pdf")) for f in pdf_files]
 
-try:
-	response = requests.post(url, files=files)
-	print("Status code:", response.status_code)
-	print("Respuesta:", response.text)
-finally:
-	# Cerrar todos los archivos abiertos
-	for _, (filename, fileobj, _) in files:
-		fileobj.close()
+async def upload(client, semaphore, file_path):
+	# Una petición por archivo: el fichero solo se abre cuando le toca subir y httpx lo envía
+	# por bloques desde disco, sin cargarlo entero en memoria
+	async with semaphore:
+		with open(file_path, "rb") as f:
+			files = [("files", (os.path.basename(file_path), f, "application/pdf"))]
+			response = await client.post(url, files=files)
+	print(f"{os.path.basename(file_path)} -> Status code: {response.status_code}")
+	return response
+
+
+async def main():
+	semaphore = asyncio.Semaphore(max_concurrent)
+	# timeout=None: la ingestión de un PDF grande puede tardar varios minutos
+	async with httpx.AsyncClient(timeout=None) as client:
+		responses = await asyncio.gather(
+			*(upload(client, semaphore, f) for f in pdf_files),
+			return_exceptions=True
+		)
+	for file_path, response in zip(pdf_files, responses):
+		if isinstance(response, Exception):
+			print(f"Error subiendo {os.path.basename(file_path)}: {response}")
+		else:
+			print("Respuesta:", response.text)
+
 
+asyncio.run(main())
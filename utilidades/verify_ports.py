@@ -1,13 +1,31 @@
 # Utilidad para verificar si los puertos de MariaDB y Qdrant están accesibles.
-import socket
+# Todos los puertos se comprueban a la vez: el tiempo total es el del más lento (como mucho TIMEOUT).
+import asyncio
 
-def check_port(port, service_name):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        result = s.connect_ex(('127.0.0.1', port))
-        if result == 0:
+TIMEOUT = 0.5 # Segundos máximos de espera por puerto
+
+SERVICES = [
+    (3306, "MariaDB"),
+    (6333, "Qdrant"),
+    (6334, "Qdrant gRPC"),
+]
+
+async def check_port(port, service_name):
+    try:
+        _reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), TIMEOUT)
+        writer.close()
+        await writer.wait_closed()
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+async def main():
+    results = await asyncio.gather(*(check_port(port, name) for port, name in SERVICES))
+    # Se imprime en el orden de SERVICES, no en el orden en que terminan las comprobaciones
+    for (port, service_name), ok in zip(SERVICES, results):
+        if ok:
             print(f"✅ {service_name} en puerto {port} está ACCESIBLE.")
         else:
             print(f"❌ {service_name} en puerto {port} NO responde.")
 
-check_port(3306, "MariaDB")
-check_port(6333, "Qdrant")
\ No newline at end of file
+asyncio.run(main())